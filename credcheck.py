@@ -1,69 +1,256 @@
-import json, argparse
+import json, argparse, os, re, sys, base64, threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-SCOPES = ["https://www.googleapis.com/auth/drive.metadata.readonly"]
+READ_SCOPES = ["https://www.googleapis.com/auth/drive.metadata.readonly",
+               "https://www.googleapis.com/auth/spreadsheets.readonly"]
+WRITE_SCOPES = ["https://www.googleapis.com/auth/drive",
+                "https://www.googleapis.com/auth/spreadsheets.readonly"]
+FOLDER_MIME = "application/vnd.google-apps.folder"
+FILE_FIELDS = "id,name,mimeType,parents,size,createdTime"
+BATCH_LIMIT = 100  # Drive caps batch requests at 100 calls
+DRIVE_ID_RE = re.compile(r'(?:[?&]id=|/d/)([a-zA-Z0-9_-]+)')
+UPLOAD_NAME_RE = re.compile(r'^\d+_[0-9a-f]{32}$')  # f"{uid}_{uuid4().hex}" from main.upload_to_drive
+GOOGLE_APPS_MIME = "application/vnd.google-apps."
+
+_local = threading.local()
+_out_lock = threading.Lock()
 
 # ────────────────────────────────────────────────────────────────
-def auth(creds_path: str):
-    with open(creds_path, "r") as f:
-        info = json.load(f)
-    return build("drive", "v3",
-                 credentials=Credentials.from_service_account_info(info, scopes=SCOPES))
+def emit(kind: str, **data):
+    line = json.dumps({"type": kind, **data}, ensure_ascii=False)
+    with _out_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+def extract_google_id(url: str) -> str:
+    match = re.search(r'/folders/([a-zA-Z0-9_-]+)', url) or \
+            re.search(r'/d/([a-zA-Z0-9_-]+)', url)
+    return match.group(1) if match else url
+
 # ────────────────────────────────────────────────────────────────
-def dump_everything(drive):
-    print("\n=== EVERY ACCESSIBLE FILE / FOLDER ===")
-    token, count = None, 0
+def auth(creds_path: str, scopes=READ_SCOPES):
+    if os.path.exists(creds_path):
+        with open(creds_path, "r") as f:
+            info = json.load(f)
+    else:
+        info = json.loads(base64.b64decode(os.environ["GOOGLE_CREDS"]).decode())
+    return Credentials.from_service_account_info(info, scopes=scopes)
+
+def client(creds, api="drive", version="v3"):
+    # googleapiclient/httplib2 objects are not thread-safe, so each worker thread builds its own
+    cache = _local.__dict__.setdefault("clients", {})
+    if api not in cache:
+        cache[api] = build(api, version, credentials=creds, cache_discovery=False)
+    return cache[api]
+
+# ────────────────────────────────────────────────────────────────
+def parse_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def time_ranges(creds, fid: str, parts: int):
+    """Split a folder into `parts` createdTime ranges between its oldest file and now. The first and
+    last ranges are open-ended, so together they cover every file exactly once."""
+    oldest = client(creds).files().list(
+        q=f"'{fid}' in parents and trashed=false",
+        corpora="allDrives", includeItemsFromAllDrives=True, supportsAllDrives=True,
+        orderBy="createdTime", fields="files(createdTime)", pageSize=1
+    ).execute().get("files", [])
+    if not oldest or parts < 2:
+        return [""]
+    start, end = parse_time(oldest[0]["createdTime"]).timestamp(), datetime.now(timezone.utc).timestamp()
+    step = (end - start) / parts
+    bounds = [datetime.fromtimestamp(start + step * i, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+              for i in range(1, parts)]
+    ranges = [f" and createdTime < '{bounds[0]}'"]
+    ranges += [f" and createdTime >= '{lo}' and createdTime < '{hi}'" for lo, hi in zip(bounds, bounds[1:])]
+    ranges.append(f" and createdTime >= '{bounds[-1]}'")
+    return ranges
+
+def list_folder(creds, fid: str, extra_q: str = ""):
+    drive, token, files = client(creds), None, []
+    while True:
+        resp = drive.files().list(
+            q=f"'{fid}' in parents and trashed=false{extra_q}",
+            corpora="allDrives", includeItemsFromAllDrives=True, supportsAllDrives=True,
+            fields=f"nextPageToken,files({FILE_FIELDS})",
+            pageSize=1000, pageToken=token
+        ).execute()
+        files.extend(resp.get("files", []))
+        token = resp.get("nextPageToken")
+        if not token:
+            return files
+
+def scan_folder(creds, root: str, workers: int = 8):
+    """List `root` as `workers` independent createdTime ranges (the app uploads into one flat folder, and
+    pages within a single listing can only be fetched in order), plus any sub-folders, streaming each file
+    as NDJSON."""
+    found = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(list_folder, creds, root, q) for q in time_ranges(creds, root, workers)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                for f in fut.result():
+                    if f["mimeType"] == FOLDER_MIME:
+                        pending.add(pool.submit(list_folder, creds, f["id"]))
+                        continue
+                    found[f["id"]] = f
+                    emit("file", **f)
+    return found
+
+def dump_everything(creds):
+    drive, token, count = client(creds), None, 0
     while True:
         resp = drive.files().list(
             q="trashed=false",
             corpora="allDrives", includeItemsFromAllDrives=True, supportsAllDrives=True,
-            fields=("nextPageToken,"
-                    "files(id,name,mimeType,driveId,parents,webViewLink,"
-                    "owners(emailAddress))"),
+            fields=f"nextPageToken,files({FILE_FIELDS},driveId)",
             pageSize=1000, pageToken=token
         ).execute()
 
         for f in resp.get("files", []):
             count += 1
-            kind   = "FOLDER" if f["mimeType"] == "application/vnd.google-apps.folder" else "FILE"
-            owners = ", ".join(o["emailAddress"] for o in f.get("owners", [])) or "(unknown)"
-            print(f"\n• {kind:6}  {f['name']}")
-            print(f"  ID      : {f['id']}")
-            print(f"  DriveId : {f.get('driveId','MyDrive')}")
-            print(f"  Parents : {', '.join(f.get('parents', [])) or '(root)'}")
-            print(f"  Owners  : {owners}")
-            print(f"  Link    : {f.get('webViewLink','(no link)')}")
+            emit("folder" if f["mimeType"] == FOLDER_MIME else "file", **f)
 
         token = resp.get("nextPageToken")
         if not token:
             break
-    print(f"\nTotal items visible to the service-account: {count}")
+    emit("summary", visible=count)
+
+# ────────────────────────────────────────────────────────────────
+def entry_file_id(entry):
+    # Current entries are {"thumb", "full", "fid"}; older rows hold plain Drive URLs
+    if isinstance(entry, dict):
+        if entry.get("fid"):
+            return entry["fid"]
+        entry = entry.get("full") or ""
+    match = DRIVE_ID_RE.search(entry) if isinstance(entry, str) else None
+    return match.group(1) if match else None
+
+def read_image_refs(creds, sheet_id: str, items_sheet: str = "items"):
+    """Map every Drive file id referenced from image_paths to its item uid. Also returns how many rows
+    couldn't be parsed; their files are unknown, so cleanup must not run while any exist."""
+    rows = client(creds, "sheets", "v4").spreadsheets().values().get(
+        spreadsheetId=sheet_id, range=f"'{items_sheet}'!A2:F"
+    ).execute().get("values", [])
+    refs, bad_rows = {}, 0
+    for row in rows:
+        if len(row) < 6 or not row[5].strip():
+            continue
+        try:
+            paths = json.loads(row[5])
+            if not isinstance(paths, list): raise ValueError("image_paths is not a list")
+        except ValueError:
+            bad_rows += 1
+            emit("bad_row", uid=row[0], image_paths=row[5])
+            continue
+        for entry in paths:
+            fid = entry_file_id(entry)
+            if fid:
+                refs[fid] = row[0]
+            else:
+                emit("unrecognised_ref", uid=row[0], entry=entry)
+    return refs, bad_rows
+
+def file_age_hours(f: dict):
+    if not f.get("createdTime"):
+        return None
+    return (datetime.now(timezone.utc) - parse_time(f["createdTime"])).total_seconds() / 3600
+
+def is_app_upload(f: dict, root: str, sheet_id: str = None) -> bool:
+    """Only files the app itself uploaded may be cleaned up: directly inside the image folder, named like
+    an upload, and never a Google Docs/Sheets file (least of all the app's own spreadsheet)."""
+    return (root in f.get("parents", [])
+            and f["id"] != sheet_id
+            and not f.get("mimeType", "").startswith(GOOGLE_APPS_MIME)
+            and bool(UPLOAD_NAME_RE.match(f.get("name", ""))))
+
+def cross_check(files: dict, refs: dict, root: str, sheet_id: str = None):
+    orphans = [fid for fid in files if fid not in refs]
+    dangling = [fid for fid in refs if fid not in files]
+    for fid in orphans:
+        emit("orphan", id=fid, name=files[fid].get("name"), size=files[fid].get("size"),
+             created=files[fid].get("createdTime"), deletable=is_app_upload(files[fid], root, sheet_id))
+    for fid in dangling:
+        emit("dangling", id=fid, uid=refs[fid])
+    return orphans, dangling
+
+def delete_files(creds, fids):
+    drive, results = client(creds), {"deleted": 0, "failed": 0}
+
+    def done(request_id, response, exception):
+        if exception is None:
+            results["deleted"] += 1
+        else:
+            results["failed"] += 1
+            emit("delete_failed", id=request_id, error=str(exception))
+
+    for i in range(0, len(fids), BATCH_LIMIT):
+        batch = drive.new_batch_http_request(callback=done)
+        for fid in fids[i:i + BATCH_LIMIT]:
+            batch.add(drive.files().delete(fileId=fid, supportsAllDrives=True), request_id=fid)
+        batch.execute()
+    emit("cleanup", **results)
 
 # ────────────────────────────────────────────────────────────────
-def check_folder(drive, fid: str):
-    print(f"\n=== Folder sanity-check: {fid} ===")
+def check_folder(creds, fid: str):
     try:
-        meta = drive.files().get(
+        meta = client(creds).files().get(
             fileId=fid,
             fields="id,name,permissions(emailAddress,role,type)",
             supportsAllDrives=True
         ).execute()
-        print("✓ Accessible:", meta['name'])
-        for p in meta.get("permissions", []):
-            print(f"   {p['role']:7} – {p['type']} ({p.get('emailAddress','n/a')})")
+        emit("folder_check", id=fid, accessible=True, name=meta["name"],
+             permissions=meta.get("permissions", []))
     except HttpError as e:
-        print("✗ Cannot access:", e)
+        emit("folder_check", id=fid, accessible=False, error=str(e))
 
 # ────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--creds", default="creds.json", help="service-account JSON file")
+    ap = argparse.ArgumentParser(description="Service-account diagnostics, output is NDJSON on stdout")
+    ap.add_argument("--creds", default="creds.json", help="service-account JSON file (falls back to GOOGLE_CREDS)")
     ap.add_argument("--folder", help="optional folder-ID to test separately")
+    ap.add_argument("--image-folder", default=os.environ.get("GOOGLE_FOLDER_URL"),
+                    help="image folder URL/ID to scan (default: GOOGLE_FOLDER_URL)")
+    ap.add_argument("--sheet", default=os.environ.get("GOOGLE_SHEET_URL"),
+                    help="spreadsheet URL/ID to cross-check image_paths against (default: GOOGLE_SHEET_URL)")
+    ap.add_argument("--all", action="store_true", help="list every file visible to the service-account")
+    ap.add_argument("--cleanup", action="store_true",
+                    help="delete orphaned uploads from the top level of the image folder (sub-folders are report-only)")
+    ap.add_argument("--min-age", type=float, default=24,
+                    help="hours an orphan must exist before --cleanup deletes it, so in-flight uploads are kept")
+    ap.add_argument("--workers", type=int, default=8, help="concurrent listings (createdTime ranges of the image folder)")
     args = ap.parse_args()
 
-    drv = auth(args.creds)
-    dump_everything(drv)
+    creds = auth(args.creds, WRITE_SCOPES if args.cleanup else READ_SCOPES)
+    if args.all:
+        dump_everything(creds)
+    if args.image_folder:
+        folder_id = extract_google_id(args.image_folder)
+        sheet_id = extract_google_id(args.sheet) if args.sheet else None
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            refs = pool.submit(read_image_refs, creds, sheet_id) if sheet_id else None
+            files = scan_folder(creds, folder_id, args.workers)
+            refs, bad_rows = refs.result() if refs else (None, 0)
+        if refs is not None:
+            orphans, dangling = cross_check(files, refs, folder_id, sheet_id)
+            emit("summary", files=len(files), referenced=len(refs), orphans=len(orphans), dangling=len(dangling),
+                 bad_rows=bad_rows)
+            if args.cleanup and bad_rows:
+                emit("cleanup_refused", reason="image_paths of some rows could not be parsed", bad_rows=bad_rows)
+            elif args.cleanup and orphans:
+                uploads = [fid for fid in orphans if is_app_upload(files[fid], folder_id, sheet_id)]
+                old_enough = [fid for fid in uploads
+                              if (file_age_hours(files[fid]) or 0) >= args.min_age]
+                emit("cleanup_skipped", reason="not an app upload in the image folder", count=len(orphans) - len(uploads))
+                emit("cleanup_skipped", reason="younger than --min-age", count=len(uploads) - len(old_enough))
+                if old_enough:
+                    delete_files(creds, old_enough)
+        else:
+            emit("summary", files=len(files))
     if args.folder:
-        check_folder(drv, args.folder)
+        check_folder(creds, args.folder)
@@ -0,0 +1,126 @@
+import os, struct, threading, time
+from bisect import bisect_left, bisect_right, insort
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# One record per stock change: uid, delta, new count, timestamp, then the user as a length-prefixed utf-8 string.
+# Records are appended to time-bucketed segment files, so a time window only touches the segments it overlaps.
+RECORD = struct.Struct('<QqqIB')
+SEGMENT_SECONDS = 7 * 86400
+SEGMENT_EXT = '.seg'
+MAX_COUNT = 2**62 - 1  # keeps count and count-to-count deltas inside the signed 64-bit fields
+
+class HistoryLog:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.offsets = {}   # segment start -> bytes already indexed
+        self.segments = {}  # segment start -> [(ts, seq, uid, delta, count, user)]
+        self.by_uid = {}    # uid -> [(ts, seq, delta, count, user)]
+        os.makedirs(path, exist_ok=True)
+        self.refresh()
+
+    def _segment_path(self, start):
+        return os.path.join(self.path, f"{start:010d}{SEGMENT_EXT}")
+
+    def _index(self, start, data, base=0):
+        pos, entries = 0, self.segments.setdefault(start, [])
+        while pos + RECORD.size <= len(data):
+            uid, delta, count, ts, ulen = RECORD.unpack_from(data, pos)
+            end = pos + RECORD.size + ulen
+            if end > len(data): break  # writer hasn't finished this record yet
+            user = data[pos + RECORD.size:end].decode('utf-8', 'replace')
+            # Writers stamp ts before they append, so file order isn't time order; keep both indexes sorted.
+            # ts is whole seconds and a second always maps to one segment, so the record's offset in that
+            # segment (seq) breaks ties in write order.
+            seq = base + pos
+            insort(entries, (ts, seq, uid, delta, count, user))
+            insort(self.by_uid.setdefault(uid, []), (ts, seq, delta, count, user))
+            pos = end
+        return pos
+
+    def refresh(self):
+        """Index any records appended since the last call, including those written by other processes."""
+        with self.lock:
+            for name in sorted(os.listdir(self.path)):
+                if not name.endswith(SEGMENT_EXT): continue
+                start = int(name[:-len(SEGMENT_EXT)])
+                known = self.offsets.get(start, 0)
+                fp = os.path.join(self.path, name)
+                if os.path.getsize(fp) <= known: continue
+                with open(fp, 'rb') as f:
+                    f.seek(known)
+                    data = f.read()
+                self.offsets[start] = known + self._index(start, data, known)
+
+    def append(self, uid, delta, count, user='', ts=None):
+        ts = int(ts if ts is not None else time.time())
+        user_b = (user or '').encode('utf-8')[:255]
+        rec = RECORD.pack(int(uid), int(delta), int(count), ts, len(user_b)) + user_b
+        start = ts - ts % SEGMENT_SECONDS
+        # O_APPEND keeps single small writes from separate workers from interleaving
+        fd = os.open(self._segment_path(start), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, rec)
+        finally:
+            os.close(fd)
+        self.refresh()
+
+    def last_count(self, uid):
+        self.refresh()
+        entries = self.by_uid.get(int(uid))
+        return entries[-1][3] if entries else None
+
+    def record(self, uid, count, user='', ts=None, fallback_count=None):
+        """Append a change to `count`, taking the delta from the latest logged count for `uid`.
+        The read and append happen under a lock shared by every worker, so concurrent saves can't
+        both compute their delta from the same previous count. `fallback_count` is called for the
+        previous count when the uid has no history yet; if it gives None no delta is known and
+        nothing is logged."""
+        with self.lock, open(os.path.join(self.path, '.lock'), 'a') as lock_f:
+            if fcntl: fcntl.flock(lock_f, fcntl.LOCK_EX)
+            try:
+                prev = self.last_count(uid)
+                if prev is None and fallback_count: prev = fallback_count()
+                if prev is None or count == prev or abs(prev) > MAX_COUNT: return
+                self.append(uid, count - prev, count, user, ts)
+            finally:
+                if fcntl: fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def item_history(self, uid, since=None, until=None, limit=None):
+        self.refresh()
+        entries = self.by_uid.get(int(uid), [])
+        lo = bisect_left(entries, (since,)) if since is not None else 0
+        hi = bisect_right(entries, (until, float('inf'))) if until is not None else len(entries)
+        out = entries[lo:hi]
+        if limit: out = out[-limit:]
+        return [{'ts': ts, 'delta': delta, 'count': count, 'user': user} for ts, _, delta, count, user in out]
+
+    def window(self, since=None, until=None):
+        self.refresh()
+        lo_seg = since - since % SEGMENT_SECONDS if since is not None else None
+        for start in sorted(self.segments):
+            if lo_seg is not None and start < lo_seg: continue
+            if until is not None and start > until: break
+            entries = self.segments[start]
+            lo = bisect_left(entries, (since,)) if since is not None else 0
+            hi = bisect_right(entries, (until, float('inf'))) if until is not None else len(entries)
+            yield from entries[lo:hi]
+
+    def aggregate(self, since=None, until=None, uid=None):
+        totals = {'changes': 0, 'added': 0, 'removed': 0, 'net': 0}
+        items = {}
+        for ts, _, e_uid, delta, count, user in self.window(since, until):
+            if uid is not None and e_uid != int(uid): continue
+            for agg in (totals, items.setdefault(str(e_uid), {'changes': 0, 'added': 0, 'removed': 0, 'net': 0})):
+                agg['changes'] += 1
+                agg['added'] += max(delta, 0)
+                agg['removed'] += -min(delta, 0)
+                agg['net'] += delta
+            items[str(e_uid)].update(count=count, ts=ts)
+        totals['items'] = len(items)
+        totals['ran_out'] = sorted(u for u, a in items.items() if a['count'] == 0)
+        return totals, items
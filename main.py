@@ -1,36 +1,79 @@
-from flask import Flask, request, jsonify, render_template_string, send_file, url_for, session, redirect,  send_from_directory
-import logging, time, json, random, re, uuid, os, base64, qrcode, gspread, hashlib
+from flask import Flask, request, jsonify, render_template, render_template_string, send_file, url_for, session, redirect,  send_from_directory, Response, g, has_request_context
+import logging, time, json, random, re, uuid, os, base64, qrcode, gspread, hashlib, gzip, mimetypes, queue, httplib2, threading
 from authlib.integrations.base_client.errors import MismatchingStateError
 from google.oauth2.service_account import Credentials
 from authlib.integrations.flask_client import OAuth
 from googleapiclient.http import MediaIoBaseUpload
 from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from gspread.exceptions import APIError
+from werkzeug.local import LocalProxy
+from types import SimpleNamespace
 from PIL import Image, ImageOps
+from history import HistoryLog, MAX_COUNT
+from rollup import CategoryRollup, children_map, walk_subtree
 from sympy import sympify
 from io import BytesIO
 from math import ceil
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 app.secret_key = hashlib.sha256(os.environ.get("BASE_SECRET", base64.b64encode(os.urandom(24)).decode()).encode()).digest()
 
-# Load .env files, used for development
+# Load .env files, used for development. Their mtimes are kept so the login allowlist can pick up edits
+ENV_FILES = {}
+
+def load_env_file(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                key, _, value = line.strip().partition("=")
+                if value.startswith('"') and value.endswith('"'):
+                    value = value[1:-1]
+                os.environ[key] = value
+    ENV_FILES[path] = os.path.getmtime(path)
+
+def reload_env_files():
+    for path, mtime in list(ENV_FILES.items()):
+        try:
+            if os.path.getmtime(path) != mtime:
+                print(f"Reloading environment variables from {path}")
+                load_env_file(path)
+        except OSError:
+            pass
+
 for root, _, files in os.walk("."):
     for file in files:
         if file.endswith(".env"):
             print(f"Loading environment variables from {file}")
-            full_path = os.path.join(root, file)
-            with open(full_path) as f:
-                for line in f:
-                    if line.strip() and not line.startswith("#"):
-                        key, _, value = line.strip().partition("=")
-                        if value.startswith('"') and value.endswith('"'):
-                            value = value[1:-1]
-                        os.environ[key] = value
-
-# Allowed gmail domains for app access
-ALLOWED_DOMAINS = os.environ.get('ALLOWED_DOMAINS', '').split(',')
-ALLOWED_EMAILS = os.environ.get('ALLOWED_EMAILS', '').split(',')
+            load_env_file(os.path.join(root, file))
+
+# Allowed gmail domains for app access, parsed into sets once and rebuilt when a .env file changes them
+_allowlist = {'raw': None, 'domains': frozenset(), 'emails': frozenset()}
+
+def parse_allowlist(raw):
+    return frozenset(p.strip().lower() for p in raw.split(',') if p.strip())
+
+def get_allowlist():
+    reload_env_files()
+    raw = (os.environ.get('ALLOWED_DOMAINS', ''), os.environ.get('ALLOWED_EMAILS', ''))
+    if raw != _allowlist['raw']:
+        _allowlist.update(raw=raw, domains=parse_allowlist(raw[0]), emails=parse_allowlist(raw[1]))
+    return _allowlist
+
+def is_allowed_email(email):
+    if not email: return False
+    email = email.strip().lower()
+    allow = get_allowlist()
+    return email in allow['emails'] or email.rpartition('@')[2] in allow['domains']
+
+get_allowlist()
 
 creds_data = base64.b64decode(os.environ['GOOGLE_CREDS']).decode()
 
@@ -72,7 +115,46 @@ creds_json = json.loads(creds_data)
 creds = Credentials.from_service_account_info(creds_json, scopes=SCOPES)
 gc = gspread.authorize(creds)
 sheet = gc.open_by_key(SPREADSHEET_ID)
-drive = build('drive', 'v3', credentials=creds)
+
+# googleapiclient services sit on a single httplib2.Http, which is not thread-safe, so Drive calls
+# borrow a client from this pool; each keeps its own keep-alive connection and is reused afterwards
+DRIVE_POOL_SIZE = int(os.environ.get('DRIVE_POOL_SIZE', '8'))
+DRIVE_BATCH_LIMIT = 100
+_drive_pool = queue.LifoQueue(maxsize=DRIVE_POOL_SIZE)
+
+def new_drive_client():
+    return build('drive', 'v3', http=AuthorizedHttp(creds, http=httplib2.Http(timeout=60)), cache_discovery=False)
+
+@contextmanager
+def drive_client():
+    try:
+        d = _drive_pool.get_nowait()
+    except queue.Empty:
+        d = new_drive_client()
+    try:
+        yield d
+    finally:
+        try: _drive_pool.put_nowait(d)
+        except queue.Full: pass
+
+def drive_batch(ids, make_request):
+    errors = {}
+    def done(request_id, response, exception):
+        if exception is not None: errors[request_id] = exception
+    with drive_client() as d:
+        for i in range(0, len(ids), DRIVE_BATCH_LIMIT):
+            batch = d.new_batch_http_request(callback=done)
+            chunk = ids[i:i + DRIVE_BATCH_LIMIT]
+            for id_ in chunk:
+                batch.add(make_request(d, id_), request_id=id_)
+            try:
+                batch.execute()
+            except Exception as e:
+                # The batch call itself failed (HTTP/transport), so none of its results can be trusted
+                errors.update((id_, e) for id_ in chunk)
+    for id_, e in errors.items():
+        logger.warning(f"Drive batch call failed for {id_}: {e}")
+    return errors
 
 def clear_blank_rows(worksheet):
     all_values = worksheet.get_all_values()
@@ -82,7 +164,6 @@ def clear_blank_rows(worksheet):
             worksheet.delete_rows(i)
             
 def repair_items_parent_id():
-    ws_items = sheet.worksheet(ITEMS_SHEET)
     all_values = ws_items.get_all_values()
     for i in range(2, len(all_values) + 1):
         row = all_values[i - 1]
@@ -92,7 +173,6 @@ def repair_items_parent_id():
                 ws_items.update_cell(i, 5, '0')
 
 def repair_categories_parent_id():
-    ws_cats = sheet.worksheet(CATEGORIES_SHEET)
     all_values = ws_cats.get_all_values()
     for i in range(2, len(all_values) + 1):
         row = all_values[i - 1]
@@ -114,6 +194,68 @@ def get_or_create_ws(title, headers):
 ws_cats = get_or_create_ws(CATEGORIES_SHEET, ['id','name','parent_id'])
 ws_items = get_or_create_ws(ITEMS_SHEET, ['uid','name','count','timestamp','category_id','image_paths'])
 
+# gspread clients share one requests session each, so they aren't safe to use from several threads or
+# greenlets at once. Each request checks a client set out of this pool on first use and returns it on
+# teardown; the module-level gc/sheet/ws_cats/ws_items names proxy to whichever set the caller holds.
+# At most SHEET_POOL_SIZE sets are ever built; beyond that requests wait for one to be returned.
+SHEET_POOL_SIZE = int(os.environ.get('SHEET_POOL_SIZE', '16'))
+SHEET_POOL_TIMEOUT = float(os.environ.get('SHEET_POOL_TIMEOUT', '30'))
+_sheet_pool = queue.LifoQueue()
+_sheet_pool_lock = threading.Lock()
+_sheet_clients_built = 1  # the startup set below seeds the pool
+_sheet_local = threading.local()
+
+def new_sheet_clients():
+    # open_by_key loads the spreadsheet metadata and worksheets() loads it again (two API calls), but
+    # with the pool bounded that only happens SHEET_POOL_SIZE times per process
+    client = gspread.authorize(creds)
+    sh = client.open_by_key(SPREADSHEET_ID)
+    by_title = {ws.title: ws for ws in sh.worksheets()}
+    return SimpleNamespace(gc=client, sheet=sh, ws_cats=by_title[CATEGORIES_SHEET], ws_items=by_title[ITEMS_SHEET])
+
+def checkout_sheet_clients():
+    global _sheet_clients_built
+    try: return _sheet_pool.get_nowait()
+    except queue.Empty: pass
+    with _sheet_pool_lock:
+        build_new = _sheet_clients_built < SHEET_POOL_SIZE
+        if build_new: _sheet_clients_built += 1
+    if build_new:
+        try:
+            return new_sheet_clients()
+        except Exception:
+            with _sheet_pool_lock: _sheet_clients_built -= 1
+            raise
+    try:
+        return _sheet_pool.get(timeout=SHEET_POOL_TIMEOUT)
+    except queue.Empty:
+        raise RuntimeError(f"No spreadsheet client free after {SHEET_POOL_TIMEOUT}s")
+
+def sheet_clients():
+    if has_request_context():
+        if 'sheet_clients' not in g:
+            g.sheet_clients = checkout_sheet_clients()
+        return g.sheet_clients
+    # Outside a request nothing returns the set, so don't take one from the pool
+    if not hasattr(_sheet_local, 'clients'):
+        _sheet_local.clients = new_sheet_clients()
+    return _sheet_local.clients
+
+@app.teardown_request
+def release_sheet_clients(exc):
+    clients = g.pop('sheet_clients', None)
+    if clients is not None:
+        _sheet_pool.put(clients)
+
+_sheet_pool.put(SimpleNamespace(gc=gc, sheet=sheet, ws_cats=ws_cats, ws_items=ws_items))
+gc       = LocalProxy(lambda: sheet_clients().gc)
+sheet    = LocalProxy(lambda: sheet_clients().sheet)
+ws_cats  = LocalProxy(lambda: sheet_clients().ws_cats)
+ws_items = LocalProxy(lambda: sheet_clients().ws_items)
+history = HistoryLog(os.environ.get('HISTORY_DIR', os.path.join(app.root_path, 'data', 'history')))
+LOW_STOCK_THRESHOLD = int(os.environ.get('LOW_STOCK_THRESHOLD', '0'))
+rollup = CategoryRollup(LOW_STOCK_THRESHOLD, int(os.environ.get('ROLLUP_TTL', '60')))
+
 def read_categories():
     data = ws_cats.get_all_records()
     data = [r for r in data if any(str(cell).strip() for cell in r.values())]
@@ -124,7 +266,7 @@ def read_categories():
     } for r in data]
 
 def read_items():
-    raw = sheet.worksheet("items").get_all_records()
+    raw = ws_items.get_all_records()
     rows = [r for r in raw if any(str(cell).strip() for cell in r.values())]
     return [{
         'uid':         str(r['uid']),
@@ -135,6 +277,10 @@ def read_items():
         'image_paths': json.loads(r['image_paths']) if r['image_paths'] else []
     } for r in rows]
 
+def parse_image_paths(raw):
+    try: return json.loads(raw) if raw else []
+    except ValueError: return []
+
 def find_cat_row(cid):  cell = ws_cats.find(str(cid), in_column=1);  return cell.row if cell else None
 def find_item_row(uid): cell = ws_items.find(str(uid), in_column=1); return cell.row if cell else None
 
@@ -147,18 +293,29 @@ def append_item(name, category_id):
     ws_items.append_row([uid, name, 0, int(time.time()), category_id or '', ''])
     return str(uid)
 
-def update_item_row(uid, name, count):
+def update_item_row(uid, name, count, user=''):
     row = find_item_row(uid); ts=int(time.time())
+    # Only an item's first history entry needs the count from the sheet; after that the log has it
+    prev_count = history.last_count(uid)
+    if prev_count is None:
+        prev = ws_items.cell(row, 3).value
+        prev_count = int(prev) if str(prev or '').strip().lstrip('-').isdigit() else 0
     ws_items.update(f'B{row}:D{row}', [[name, count, ts]])
+    history.record(uid, count, user, fallback_count=lambda: prev_count)
+
+def get_rollup(cats=None, items=None):
+    if rollup.stale():
+        rollup.build(cats if cats is not None else read_categories(), items if items is not None else read_items())
+    return rollup
 
-def duplicate_exists(target_cat_id, name, is_category, exclude=None):
+def duplicate_exists(target_cat_id, name, is_category, exclude=None, cats=None, items=None):
     name_l = name.lower()
     if is_category:
-        for c in read_categories():
+        for c in cats if cats is not None else read_categories():
             if c['parent_id']==target_cat_id and c['name'].lower()==name_l and c['id']!=exclude:
                 return True
     else:
-        for i in read_items():
+        for i in items if items is not None else read_items():
             if i['category_id']==target_cat_id and i['name'].lower()==name_l and i['uid']!=exclude:
                 return True
     return False
@@ -228,12 +385,14 @@ def handle_mismatch_state(e):
     </html>
     """), 302
 
+PUBLIC_ENDPOINTS = frozenset(('login', 'authorize', 'static', 'serve_asset', 'privacy', 'info'))
+
 @app.before_request
 def require_login():
     if not ENABLE_AUTH_REQ:
         return
 
-    if request.endpoint in ('login', 'authorize', 'static', 'privacy', 'info'):
+    if request.endpoint in PUBLIC_ENDPOINTS:
         return
 
     if 'email' not in session:
@@ -251,17 +410,12 @@ def logout():
 
 @app.route('/authorize')
 def authorize():
-    ALLOWED_DOMAINS = os.environ.get('ALLOWED_DOMAINS', '').split(',')
-    ALLOWED_EMAILS = os.environ.get('ALLOWED_EMAILS', '').split(',')
-    
     token = google.authorize_access_token()
-    user_info = google.get('https://openidconnect.googleapis.com/v1/userinfo').json()
-    email = user_info.get('email')
+    # authlib verifies the ID token and exposes its claims, so no extra userinfo round-trip is needed
+    claims = token.get('userinfo') or {}
+    email = claims.get('email') if claims.get('email_verified', True) else None
 
-    if not email or (
-        email not in ALLOWED_EMAILS and
-        not any(email.endswith(f"@{domain}") for domain in ALLOWED_DOMAINS)
-    ):
+    if not is_allowed_email(email):
         return """
                 <script>
                   alert("You are not allowed to login with an email using that domain.");
@@ -289,8 +443,8 @@ def gen_qr(b64url):
 
 @app.route('/repair')
 def repair():
-    clear_blank_rows(sheet.worksheet("items"))
-    clear_blank_rows(sheet.worksheet("categories"))
+    clear_blank_rows(ws_items)
+    clear_blank_rows(ws_cats)
     repair_categories_parent_id()
     repair_items_parent_id()
     return """
@@ -316,12 +470,11 @@ def explorer():
         its       = [i for i in items if i['category_id'] == 0 or i['category_id'] is None]
         bc_html, parent_id, parentPath = '<b>/</b>', None, None
 
-    return render_template_string(EXPLORER_HTML,
+    return render_template(EXPLORER_TPL,
         category={'id': cid, 'parent_id': parent_id},
-        subcategories=subcats, items=its,
+        subcategories=subcats, items=its, cats=cats, rollup=get_rollup(cats, items),
         breadcrumb=bc_html, parentPath=parentPath,
-        build_breadcrumb_str=build_breadcrumb_str,
-        read_categories=read_categories)
+        build_breadcrumb_str=build_breadcrumb_str)
 
 @app.route('/api/items_index')
 def items_index():
@@ -357,6 +510,7 @@ def new_category():
     parent_id = request.form.get('parent_id'); parent_id=int(parent_id) if parent_id else None
     if duplicate_exists(parent_id,name,True):   return jsonify(success=False,message='Duplicate')
     cid=append_category(name,parent_id)
+    rollup.add_category(cid,parent_id)
     return jsonify(success=True,id=cid,message='Created')
 
 @app.route('/api/new_item',methods=['POST'])
@@ -366,6 +520,7 @@ def new_item():
     category_id = request.form.get('category_id'); category_id=int(category_id) if category_id else None
     if duplicate_exists(category_id,name,False): return jsonify(success=False,message='Duplicate')
     uid = append_item(name,category_id)
+    rollup.add_item(uid,name,category_id)
     return jsonify(success=True,uid=uid,message='Created')
 
 def resolve_target_category(abs_path,cats):
@@ -389,21 +544,21 @@ def move():
         cat = next((c for c in cats if str(c['id'])==id_),None)
         if not cat: return jsonify(success=False,message='Cat not found')
 
-        anc=target_cat
-        while anc:
-            if anc['id']==cat['id']: return jsonify(success=False)
-            anc = next((c for c in cats if c['id']==anc['parent_id']),None)
-        if duplicate_exists(target_id,cat['name'],True,exclude=cat['id']):
+        if target_id is not None and target_id in set(walk_subtree(cat['id'],children_map(cats))):
+            return jsonify(success=False,message='Cannot move a category into itself')
+        if duplicate_exists(target_id,cat['name'],True,exclude=cat['id'],cats=cats):
             return jsonify(success=False,message='Name exists in target')
         row=find_cat_row(cat['id']); ws_cats.update_cell(row,3,target_id or '')
+        rollup.move_category(cat['id'],target_id)
         return jsonify(success=True,message='Moved')
 
     if t=='item':
         it = next((i for i in items if i['uid']==id_),None)
         if not it: return jsonify(success=False,message='Item not found')
-        if duplicate_exists(target_id,it['name'],False,exclude=it['uid']):
+        if duplicate_exists(target_id,it['name'],False,exclude=it['uid'],items=items):
             return jsonify(success=False,message='Name exists in target')
         row=find_item_row(it['uid']); ws_items.update_cell(row,5,target_id or '')
+        rollup.move_item(it['uid'],target_id)
         return jsonify(success=True,message='Moved')
 
     return jsonify(success=False,message='Invalid type')
@@ -412,72 +567,128 @@ def move():
 def delete():
     t,id_ = request.form['type'],request.form['id']
     if t=='item':
-        row=find_item_row(id_); ws_items.batch_clear([f"A{row}:F{row}"])
+        row=find_item_row(id_)
+        if not row: return jsonify(success=False,message='Item not found')
+        values=ws_items.row_values(row)
+        ws_items.batch_clear([f"A{row}:F{row}"])
+        delete_images(parse_image_paths(values[5] if len(values)>5 else ''))
+        rollup.remove_item(id_)
         return jsonify(success=True,message='Item deleted')
     if t=='category':
-        cats = read_categories()
-        if any(i for i in read_items() if i['category_id']==int(id_)):
+        cascade = request.form.get('cascade','').lower() in ('1','true','yes')
+        cat_values, item_values = ws_cats.get_all_values(), ws_items.get_all_values()
+        cats = [{'id': int(r[0]), 'parent_id': int(r[2]) if len(r)>2 and r[2].strip().isdigit() else None, 'row': n}
+                for n,r in enumerate(cat_values[1:],2) if r and r[0].strip().isdigit()]
+        if not any(str(c['id'])==id_ for c in cats): return jsonify(success=False,message='Category not found')
+        to_delete = set(walk_subtree(int(id_),children_map(cats)))
+        item_rows = [n for n,r in enumerate(item_values[1:],2)
+                     if len(r)>4 and r[4].strip().isdigit() and int(r[4]) in to_delete]
+        if item_rows and not cascade:
             return jsonify(success=False,message='Not empty')
 
-        to_delete=[int(id_)]
-        while True:
-            extra = [c['id'] for c in cats if c['parent_id'] in to_delete]
-            if not extra: break
-            to_delete.extend(extra)
-        for cid in to_delete:
-            row=find_cat_row(cid); ws_cats.batch_clear([f"A{row}:C{row}"])
-        return jsonify(success=True,message='Category deleted')
+        # Clear the whole subtree (and its items when cascading) in a single values.batchClear request
+        ranges = [f"'{CATEGORIES_SHEET}'!A{c['row']}:C{c['row']}" for c in cats if c['id'] in to_delete] + \
+                 [f"'{ITEMS_SHEET}'!A{n}:F{n}" for n in item_rows]
+        sheet.values_batch_clear(body={'ranges': ranges})
+        delete_images([e for n in item_rows if len(item_values[n-1])>5 for e in parse_image_paths(item_values[n-1][5])])
+        rollup.remove_categories(to_delete,[item_values[n-1][0] for n in item_rows])
+        return jsonify(success=True,message='Category deleted',categories=len(to_delete),items=len(item_rows))
     return jsonify(success=False,message='Invalid type')
 
 UPLOAD_DIR = os.path.join(app.root_path, 'static', 'uploads')
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+def delete_images(entries):
+    entries = [e for e in entries if isinstance(e, dict)]
+    fids = [e['fid'] for e in entries if e.get('fid')]
+    if fids:
+        drive_batch(fids, lambda d, fid: d.files().delete(fileId=fid, supportsAllDrives=True))
+    for e in entries:
+        local = os.path.join(app.root_path, e.get('thumb', '').lstrip('/'))
+        if e.get('thumb') and os.path.isfile(local):
+            os.remove(local)
+
+MAX_IMAGES = 3
+
+def upload_to_drive(uid, raw, mimetype):
+    media = MediaIoBaseUpload(BytesIO(raw),
+                              mimetype=mimetype or 'application/octet-stream',
+                              resumable=False)
+    try:
+        with drive_client() as d:
+            return d.files().create(
+                body={'name': f"{uid}_{uuid.uuid4().hex}", 'parents': [IMAGE_FOLDER_ID]},
+                media_body=media,
+                fields='id',
+                supportsAllDrives=True
+            ).execute()['id']
+    except Exception as e:
+        logger.warning(f"Drive upload failed for {uid}: {e}")
+        return None
+
+def make_thumb(raw):
+    img = ImageOps.exif_transpose(Image.open(BytesIO(raw))).convert("RGBA")
+    out = BytesIO()
+    img.resize((128, 128), Image.Resampling.LANCZOS).save(out, "WEBP")
+    return out.getvalue()
+
 @app.route('/api/upload_image/<uid>', methods=['POST'])
 def upload_image(uid):
-    if 'file' not in request.files:
+    files = [f for f in request.files.getlist('file') if f]
+    if not files:
         return jsonify(success=False, message='No file')
+    row = find_item_row(uid)
+    if not row:
+        return jsonify(success=False, message='Item not found')
+    imgs = parse_image_paths(ws_items.cell(row, 6).value)
+    if len(imgs) + len(files) > MAX_IMAGES:
+        return jsonify(success=False, message=f'An item can have at most {MAX_IMAGES} images')
+
+    # Decode and thumbnail everything before any of it reaches Drive, so a bad file leaves nothing behind
+    uploads = []
+    for f in files:
+        raw = f.read()
+        try:
+            thumb = make_thumb(raw)
+        except Exception:
+            return jsonify(success=False, message=f'{f.filename or "File"} is not a valid image')
+        uploads.append((raw, f.mimetype, thumb))
 
-    f = request.files['file']
-    raw = f.read()
-    stream = BytesIO(raw)
-
-    meta = {
-        'name': f"{uid}_{uuid.uuid4().hex}",
-        'parents': [IMAGE_FOLDER_ID]
-    }
-    media = MediaIoBaseUpload(stream,
-                              mimetype=f.mimetype or 'application/octet-stream',
-                              resumable=False)
-
-    fid = drive.files().create(
-        body=meta,
-        media_body=media,
-        fields='id',
-        supportsAllDrives=True
-    ).execute()['id']
+    # Media uploads can't go in a batch request, so run them side by side on pooled clients
+    with ThreadPoolExecutor(max_workers=min(len(uploads), DRIVE_POOL_SIZE)) as pool:
+        fids = list(pool.map(lambda u: upload_to_drive(uid, u[0], u[1]), uploads))
 
-    drive.permissions().create(
+    share = lambda d, fid: d.permissions().create(
         fileId=fid,
         body={'role': 'reader', 'type': 'anyone'},
         supportsAllDrives=True
-    ).execute()
-
-    full_url = f"https://drive.usercontent.google.com/download?id={fid}&authuser=0"
-
-    img = ImageOps.exif_transpose(Image.open(BytesIO(raw))).convert("RGBA")
-    thumb = img.resize((128, 128), Image.Resampling.LANCZOS)
-    thumb_name = f"{uid}_{uuid.uuid4().hex}_thumb.webp"
-    thumb_path = os.path.join(UPLOAD_DIR, thumb_name)
-    thumb.save(thumb_path, "WEBP")
-    thumb_url = f"/static/uploads/{thumb_name}"
-
-    row = find_item_row(uid)
-    items = read_items()
-    imgs = next(i['image_paths'] for i in items if i['uid'] == uid)
-    imgs.append({"thumb": thumb_url, "full": full_url, "fid": fid})
+    )
+    created = [fid for fid in fids if fid]
+    failed = list(drive_batch(created, share)) if created else []
+    if failed:
+        failed = list(drive_batch(failed, share))  # one retry for transient errors
+    if failed:
+        # Without the grant the full-size link would 403, so drop those uploads entirely
+        drive_batch(failed, lambda d, fid: d.files().delete(fileId=fid, supportsAllDrives=True))
+    uploads = [(u, fid) for u, fid in zip(uploads, fids) if fid and fid not in failed]
+    failed_count = len(files) - len(uploads)
+    if not uploads:
+        return jsonify(success=False, message='Could not upload the image to Drive')
+
+    added = []
+    for (_, _, thumb), fid in uploads:
+        full_url = f"https://drive.usercontent.google.com/download?id={fid}&authuser=0"
+        thumb_name = f"{uid}_{uuid.uuid4().hex}_thumb.webp"
+        with open(os.path.join(UPLOAD_DIR, thumb_name), 'wb') as out:
+            out.write(thumb)
+        thumb_url = f"/static/uploads/{thumb_name}"
+
+        imgs.append({"thumb": thumb_url, "full": full_url, "fid": fid})
+        added.append({"image_path": thumb_url, "full_path": full_url})
     ws_items.update_cell(row, 6, json.dumps(imgs))
 
-    return jsonify(success=True, image_path=thumb_url, full_path=full_url)
+    message = f'{failed_count} image(s) could not be uploaded and were not saved' if failed_count else None
+    return jsonify(success=True, images=added, failed=failed_count, message=message, **added[0])
 
 @app.route('/api/delete_image/<uid>', methods=['POST'])
 def delete_image(uid):
@@ -486,23 +697,16 @@ def delete_image(uid):
         return jsonify(success=False, message='No thumb')
     
     row = find_item_row(uid)
-    items = read_items()
-    item = next(i for i in items if i['uid'] == uid)
-    entry = next((e for e in item['image_paths'] if isinstance(e, dict) and e.get("thumb") == thumb), None)
+    if not row:
+        return jsonify(success=False, message='Item not found')
+    imgs = parse_image_paths(ws_items.cell(row, 6).value)
+    entry = next((e for e in imgs if isinstance(e, dict) and e.get("thumb") == thumb), None)
     if not entry:
         return jsonify(success=False, message='Not found')
 
-    try:
-        drive.files().delete(fileId=entry.get("fid")).execute()
-    except Exception:
-        pass
-
-    local = os.path.join(app.root_path, thumb.lstrip('/'))
-    if os.path.exists(local):
-        os.remove(local)
-
-    item['image_paths'].remove(entry)
-    ws_items.update_cell(row, 6, json.dumps(item['image_paths']))
+    delete_images([entry])
+    imgs.remove(entry)
+    ws_items.update_cell(row, 6, json.dumps(imgs))
 
     return jsonify(success=True, message='Deleted')
 
@@ -513,8 +717,8 @@ def edit(uid):
     if not item: return "Item not found",404
     parent = request.args.get('cat','')
     breadcrumb=build_breadcrumb_html(item['category_id'],cats) if item['category_id'] else '<b>/</b>'
-    return render_template_string(EDITOR_HTML,item=item,images=item['image_paths'],
-                                  breadcrumb=breadcrumb,parent=parent)
+    return render_template(EDITOR_TPL,item=item,images=item['image_paths'],
+                           breadcrumb=breadcrumb,parent=parent)
 
 @app.route('/api/item/<uid>',methods=['POST'])
 def item_api(uid):
@@ -522,10 +726,39 @@ def item_api(uid):
     count_raw = request.form['count']
     if not re.fullmatch(r'[A-Za-z0-9 _\-,.]+',name): return jsonify(success=False,message='Invalid')
     if not re.fullmatch(r'[0-9+\-*/(). ]*',count_raw): return jsonify(success=False,message='Invalid count')
-    count=int(ceil(sympify(re.sub(r'[^0-9+\-*/(). ]','',count_raw) or '0').evalf()))
-    update_item_row(uid,name,count)
+    try:
+        count=int(ceil(sympify(re.sub(r'[^0-9+\-*/(). ]','',count_raw) or '0').evalf()))
+    except (TypeError, ValueError, OverflowError):
+        return jsonify(success=False,message='Invalid count')
+    if abs(count) > MAX_COUNT: return jsonify(success=False,message='Count too large')
+    update_item_row(uid,name,count,session.get('email',''))
+    rollup.update_item(uid,name,count)
     return jsonify(success=True)
 
+@app.route('/api/low_stock')
+def low_stock():
+    threshold = request.args.get('threshold',default=LOW_STOCK_THRESHOLD,type=int)
+    cid = request.args.get('cat',type=int)
+    r = get_rollup()
+    items = sorted(r.low_stock(threshold,cid),key=lambda i:(i['count'],i['name'].lower()))
+    return jsonify(success=True,threshold=threshold,category=cid,totals=r.get(cid),items=items)
+
+@app.route('/api/history/<uid>')
+def item_history(uid):
+    if not uid.isdigit(): return jsonify(success=False,message='Invalid uid')
+    since, until = request.args.get('since',type=int), request.args.get('until',type=int)
+    entries = history.item_history(uid,since,until,request.args.get('limit',type=int))
+    last_zero = next((e['ts'] for e in reversed(entries) if e['count']==0),None)
+    return jsonify(success=True,uid=uid,history=entries,last_zero=last_zero)
+
+@app.route('/api/history')
+def history_window():
+    since, until = request.args.get('since',type=int), request.args.get('until',type=int)
+    uid = request.args.get('uid')
+    if uid is not None and not uid.isdigit(): return jsonify(success=False,message='Invalid uid')
+    totals, items = history.aggregate(since,until,uid)
+    return jsonify(success=True,since=since,until=until,totals=totals,items=items)
+
 @app.route('/export')
 def export(): return jsonify(categories=read_categories(),items=read_items())
 
@@ -535,22 +768,65 @@ def view_image(filename):
     p=os.path.join(app.root_path,'static','uploads',filename)
     return send_file(p,mimetype='image/webp',as_attachment=False) if os.path.exists(p) else ('Not found',404)
 
+# Fingerprinted, precompressed static assets (css/js/vendor) served with immutable caching
+ASSET_DIRS = ('css', 'js', 'vendor')
+ASSET_MAX_AGE = 31536000
+ASSETS, ASSET_URLS = {}, {}
+
+def build_assets():
+    static_dir = os.path.join(app.root_path, 'static')
+    for sub in ASSET_DIRS:
+        base = os.path.join(static_dir, sub)
+        if not os.path.isdir(base): continue
+        for name in sorted(os.listdir(base)):
+            path = os.path.join(base, name)
+            if not os.path.isfile(path): continue
+            with open(path, 'rb') as f:
+                raw = f.read()
+            digest = hashlib.sha256(raw).hexdigest()[:12]
+            stem, ext = os.path.splitext(name)
+            logical, hashed = f"{sub}/{name}", f"{sub}/{stem}.{digest}{ext}"
+            ASSETS[hashed] = {
+                'raw':      raw,
+                'gzip':     gzip.compress(raw, 9),
+                'br':       brotli.compress(raw) if brotli else None,
+                'etag':     digest,
+                'mimetype': mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            }
+            ASSET_URLS[logical] = f"/assets/{hashed}"
+            logger.debug(f"Built asset {logical} -> {hashed}")
+
+def asset_url(name): return ASSET_URLS.get(name) or url_for('static', filename=name)
+
+@app.route('/assets/<path:name>')
+def serve_asset(name):
+    asset = ASSETS.get(name)
+    if not asset: return 'Not found', 404
+    headers = {
+        'Cache-Control': f'public, max-age={ASSET_MAX_AGE}, immutable',
+        'ETag':          f'"{asset["etag"]}"',
+        'Vary':          'Accept-Encoding'
+    }
+    if request.if_none_match.contains(asset['etag']):
+        return Response(status=304, headers=headers)
+
+    accepted = request.headers.get('Accept-Encoding', '')
+    body = asset['raw']
+    if asset['br'] and 'br' in accepted:
+        body, headers['Content-Encoding'] = asset['br'], 'br'
+    elif 'gzip' in accepted:
+        body, headers['Content-Encoding'] = asset['gzip'], 'gzip'
+    return Response(body, mimetype=asset['mimetype'], headers=headers)
+
+build_assets()
+
 EXPLORER_HTML = """
 <!DOCTYPE html><html><head><meta charset="utf-8"><title>Stocky</title>
 <meta name="viewport" content="width=device-width, initial-scale=1.0">
 <link rel="icon" href="https://newbo.co/wp-content/uploads/2022/11/newboco-logo-site-icon-300x300.jpg" sizes="192x192" />
-<style>body{background:#2c2c2c;color:#f0f0f0;font-family:Arial,sans-serif;margin:0}
-.explorer{padding:20px}.header{display:flex;flex-direction:column;gap:5px}
-.breadcrumb{padding-bottom:10px;font-size:14px}
-.controls{display:flex;justify-content:space-between;align-items:center}
-.buttons button{padding:5px 10px;margin-right:3px;background:#fff;color:#000;border:1.5px solid #000;border-radius:7px;cursor:pointer}
-.list{margin-top:20px}.folder,.item{padding:10px;border:1px solid #444;margin-bottom:5px;cursor:pointer}
-.folder:hover,.item:hover{background:#444}.selected{border:2px solid #007bff}
-.back-folder{background:#333}.empty-message{color:#888;font-size:14px;padding-bottom:20px}
-.folder.drag-over, .item.drag-over {background-color: #555;}
-.folder, .item {-webkit-user-select: none;-moz-user-select: none;-ms-user-select: none;user-select: none;-webkit-touch-callout: none;}
-</style><script src="https://code.jquery.com/jquery-3.6.0.min.js"></script></head>
-<body><div class="explorer">
+<link rel="stylesheet" href="{{ asset_url('css/explorer.css') }}">
+<script src="{{ asset_url('vendor/jquery-3.6.1.min.js') }}"></script></head>
+<body data-cat-id="{{category.id if category.id else ''}}" data-parent-id="{{category.parent_id if category.id and category.parent_id else ''}}"><div class="explorer">
 <div class="header"><span class="breadcrumb">{{breadcrumb|safe}}</span>
 <div class="controls"><div class="buttons">
 <button onclick="newSubCategory()">New Sub Category</button>
@@ -566,11 +842,12 @@ EXPLORER_HTML = """
                 </div>
             {% endif %}
             {% for cat in subcategories %}
-                <div class="folder" data-id="{{ cat.id }}" data-path="{{ build_breadcrumb_str(cat.id, read_categories()) }}"
+                <div class="folder" data-id="{{ cat.id }}" data-path="{{ build_breadcrumb_str(cat.id, cats) }}"
                      draggable="true" 
                      ondragstart="dragStart(event, this)" ondragover="dragOver(event,this)" ondragleave="dragLeave(event,this)" ondrop="drop(event, this)" 
                      onclick="selectItem(this, 'category', '{{ cat.id }}')" ondblclick="openFolder({{ cat.id }})">
                     📁 {{ cat.name }}
+                    {% set r = rollup.get(cat.id) %}<span class="rollup">{{ r['items'] }} items · {{ r['stock'] }} in stock{% if r['zero'] %} · {{ r['zero'] }} out{% endif %}{% if r['low'] %} · {{ r['low'] }} low{% endif %}</span>
                 </div>
             {% endfor %}
             {% for item in items %}
@@ -586,74 +863,23 @@ EXPLORER_HTML = """
                 </div>
 {% endif %}
 </div></div>
-<script>
-let selected=null;
-function selectItem(el,t,id){document.querySelectorAll('.selected').forEach(x=>x.classList.remove('selected'));el.classList.add('selected');selected={type:t,id:id}}
-function goBack(){const pid='{{category.parent_id if category.id else ""}}';location.href=pid?"/?cat="+pid:"/"}
-function openFolder(id){location.href="/?cat="+id}
-function openItem(uid){const p=new URLSearchParams(location.search);const c=p.get('cat');location.href="/edit/"+uid+(c?"?cat="+c:"")}
-function newSubCategory(){const name=prompt("Enter sub category name:");if(!name)return;$.post("/api/new_category",{name,parent_id:'{{category.id if category.id else ""}}'}).done(d=>d.success?location.reload():alert(d.message))}
-function newItem(){const name=prompt("Enter item name:");if(!name)return;$.post("/api/new_item",{name,category_id:'{{category.id if category.id else ""}}'}).done(d=>d.success?location.reload():alert(d.message))}
-function deleteSelected(){if(!selected)return alert("Select something first.");if(!confirm("Delete "+selected.type+"?"))return;$.post("/api/delete",selected).done(d=>d.success?location.reload():alert(d.message))}
-  function dragStart(e,el){
-    let type = el.classList.contains("folder") ? "category" : "item";
-    let id   = type==="category" ? el.dataset.id : el.dataset.uid;
-    e.dataTransfer.setData("application/json", JSON.stringify({type,id}));
-  }
-
-  function dragOver(e,el){
-    e.preventDefault();
-    el.classList.add("drag-over");
-  }
-
-  function dragLeave(e,el){
-    el.classList.remove("drag-over");
-  }
-
-  function drop(e,el){
-    e.preventDefault();
-    el.classList.remove("drag-over");
-    let raw = e.dataTransfer.getData("application/json");
-    if(!raw) return;
-    let obj = JSON.parse(raw);
-    let path = el.getAttribute("data-path");
-    if(!path) return alert("Invalid drop target");
-    $.post("/api/move", { type: obj.type, id: obj.id, path }, res => {
-  if (!res.success) {
-    if (res.message) { 
-      alert(res.message);
-    }
-  } else {
-    location.reload();
-  }
-    });
-  }
-</script></body></html>
+<script src="{{ asset_url('js/explorer.js') }}"></script></body></html>
 """
 
 EDITOR_HTML = """
 <!DOCTYPE html><html><head><meta charset='utf-8'><title>Stocky – Edit</title>
 <meta name="viewport" content="width=device-width, initial-scale=1.0">
 <link rel="icon" href="https://newbo.co/wp-content/uploads/2022/11/newboco-logo-site-icon-300x300.jpg" sizes="192x192" />
-<style>
-body{background:#2c2c2c;color:#f0f0f0;font-family:Arial,sans-serif;padding:20px}
-.editor{max-width:600px;margin:auto}
-input{width:100%;padding:10px;margin-bottom:10px;background:#444;border:1px solid #666;color:#f0f0f0}
-.buttons{position:fixed;bottom:20px;right:20px}.buttons button{margin-left:5px;padding:10px 20px}
-.cancel{background:#fff;color:#888;border:1px solid #888}.save{background:#007bff;color:#fff;border:none}
-.spancopy{cursor:pointer;font-family:monospace;background:#424242;color:#E7E7E7;padding:2px 5px;border-radius:4px}
-#imageUploadContainer,#imageContainer{display:flex;flex-wrap:wrap;gap:10px}
-#uploadWrapper{width:128px;height:128px;cursor:pointer}#uploadWrapper img{width:100%;height:100%}
-.uploaded-img{width:128px;height:128px;object-fit:cover;cursor:pointer}
-</style><script src='https://code.jquery.com/jquery-3.6.0.min.js'></script></head>
-<body>
+<link rel='stylesheet' href='{{ asset_url('css/editor.css') }}'>
+<script src='{{ asset_url('vendor/jquery-3.6.1.min.js') }}'></script></head>
+<body data-uid="{{ item.uid }}" data-parent="{{ parent }}">
 <div class='editor'>
 <h2>Editing item <code title="Generate QR code for this item" class='spancopy' onclick='genQR()'>{{ item.uid }}</code>:</h2>
 <label>Name:<input type='text' id='name' value='{{ item.name }}'></label>
 <label>Count:<input pattern='[0-9+\\-*/(). ]*' type='text' id='count' value='{{ item.count }}'></label>
 <div id='imageUploadContainer'>
   <div id='uploadWrapper'>
-    <img id='uploadBtn' src='/static/upload_button.png'><input id='imageInput' type='file' accept='image/*' style='display:none'>
+    <img id='uploadBtn' src='/static/upload_button.png'><input id='imageInput' type='file' accept='image/*' multiple style='display:none'>
   </div>
   <div id='imageContainer'>
     {% for url in images %}
@@ -667,99 +893,14 @@ input{width:100%;padding:10px;margin-bottom:10px;background:#444;border:1px soli
 </div>
 </div>
 <div class='buttons'><button class='cancel' onclick='cancel()'>Cancel</button><button class='save' onclick='save()'>Save & Exit</button></div>
-<script>
-const uid    = "{{ item.uid }}";
-const parent = "{{ parent }}";
-const $btnImg = $("#uploadBtn");
-const UP_ICON    = "/static/upload_button.png";
-const LOADING_GIF= "/static/loading.gif";
-
-function genQR() {
-    const url = window.location.href;
-    const encoded = btoa(url)
-        .replace(/\+/g, '-')
-        .replace(/\//g, '_')
-        .replace(/=+$/, '');
-    window.open('/api/qr/' + encoded, '_blank');
-}
-
-function copyid(e){
-  const s=e.target, t=s.textContent;
-  navigator.clipboard.writeText(t).then(()=>{
-    s.textContent="Copied!"; setTimeout(()=>s.textContent=t,1e3);
-  });
-}
-
-function toggleUploadButton(){
-  $("#uploadWrapper").toggle($("#imageContainer img").length < 3);
-}
-toggleUploadButton();
-
-function save(){
-  $.post("/api/item/"+uid,{name:$("#name").val(),count:$("#count").val()})
-    .done(d=> d.success ? location.href="/?cat="+parent : alert(d.message));
-}
-function cancel(){ location.href="/?cat="+parent }
-
-function spinner(on){
-  $btnImg.attr("src", on ? LOADING_GIF : UP_ICON);
-  $("#uploadWrapper").css("pointer-events", on ? "none" : "auto");
-}
-spinner(true);
-$(window).on("load", ()=> spinner(false));
-
-$("#uploadBtn").click(()=> $("#imageInput").click());
-$("#imageInput").on("change", e=>{
-  const f=e.target.files[0]; if(!f) return;
-  const fd=new FormData(); fd.append("file",f);
-
-  spinner(true);
-  $.ajax({
-    url:`/api/upload_image/${uid}`,
-    type:"POST",
-    data:fd,
-    processData:false,
-    contentType:false
-  }).done(d=>{
-    spinner(false);
-    if(d.success){
-      $("#imageContainer").append(
-        `<img class="uploaded-img" src="${d.image_path}" data-full="${d.full_path}">`
-      );
-      toggleUploadButton();
-      $("#imageInput").val("");
-    } else alert(d.message);
-  }).fail(()=> spinner(false));
-});
-
-$(document).on("click", ".uploaded-img", function(){
-  const img=this;
-
-  if(img.__timer){
-    clearTimeout(img.__timer); img.__timer=null;
-
-    if(confirm("Delete this image?")){
-      spinner(true);
-      const rel = img.src.startsWith(location.origin)
-                 ? img.src.slice(location.origin.length) : img.src;
-
-      $.post(`/api/delete_image/${uid}`, { thumb: rel })
-        .done(d=>{
-          spinner(false);
-          if(d.success){ $(img).remove(); toggleUploadButton(); }
-          else alert(d.message);
-        }).fail(()=> spinner(false));
-    }
-  }else{
-    img.__timer=setTimeout(()=>{
-      img.__timer=null;
-      window.open($(img).data("full"), "_blank");
-    },300);
-  }
-});
-</script>
+<script src='{{ asset_url('js/editor.js') }}'></script>
 </body></html>
 """
 
+# Compile page templates once at startup instead of on every request
+app.jinja_env.globals['asset_url'] = asset_url
+EXPLORER_TPL = app.jinja_env.from_string(EXPLORER_HTML)
+EDITOR_TPL = app.jinja_env.from_string(EDITOR_HTML)
+
 if __name__=='__main__':
     app.run(host='0.0.0.0',port=80,debug=False)
\ No newline at end of file
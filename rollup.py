@@ -0,0 +1,154 @@
+import threading, time
+
+FIELDS = ('items', 'stock', 'zero', 'low')
+
+def _blank(): return dict.fromkeys(FIELDS, 0)
+
+def children_map(cats):
+    children = {}
+    for c in cats:
+        children.setdefault(c['parent_id'], []).append(c['id'])
+    return children
+
+def walk_subtree(cid, children):
+    # The sheet is edited by hand, so guard against parent cycles the same way _chain does
+    out, stack, seen = [], [cid], set()
+    while stack:
+        cur = stack.pop()
+        if cur in seen: continue
+        seen.add(cur)
+        if cur is not None: out.append(cur)
+        stack.extend(children.get(cur, []))
+    return out
+
+class CategoryRollup:
+    """Per-category totals over the whole subtree (item count, summed stock, items at zero, items at/below
+    the low-stock threshold). Built once from the sheets, then kept current by walking only the ancestor
+    chain of whatever changed. Rebuilt from scratch after `ttl` seconds to pick up edits made elsewhere."""
+
+    def __init__(self, low_threshold=0, ttl=60):
+        self.low_threshold = low_threshold
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.built_at = None
+
+    def build(self, cats, items):
+        with self.lock:
+            self.parent = {c['id']: c['parent_id'] for c in cats}
+            self.children = children_map(cats)
+            self.items = {i['uid']: {'name': i['name'], 'category_id': i['category_id'] or None, 'count': i['count']}
+                          for i in items}
+            self.totals = {cid: _blank() for cid in self.parent}
+            self.totals[None] = _blank()
+            for item in self.items.values():
+                self._apply(item['category_id'], self._stats(item['count']), 1)
+            self.built_at = time.time()
+
+    def stale(self):
+        return self.built_at is None or time.time() - self.built_at > self.ttl
+
+    def invalidate(self):
+        self.built_at = None
+
+    def _stats(self, count):
+        return {'items': 1, 'stock': count, 'zero': int(count == 0), 'low': int(count <= self.low_threshold)}
+
+    def _chain(self, cid):
+        seen = set()
+        while cid is not None and cid not in seen:
+            seen.add(cid); yield cid
+            cid = self.parent.get(cid)
+        yield None
+
+    def _apply(self, cid, stats, sign):
+        for anc in self._chain(cid):
+            tot = self.totals.setdefault(anc, _blank())
+            for k in FIELDS: tot[k] += sign * stats[k]
+
+    def _ready(self):
+        return self.built_at is not None
+
+    def get(self, cid):
+        return self.totals.get(cid, _blank()) if self._ready() else _blank()
+
+    def count(self, uid):
+        item = self.items.get(uid) if self._ready() else None
+        return item['count'] if item else None
+
+    def add_category(self, cid, parent_id):
+        with self.lock:
+            if not self._ready(): return
+            self.parent[cid] = parent_id
+            self.children.setdefault(parent_id, []).append(cid)
+            self.totals[cid] = _blank()
+
+    def add_item(self, uid, name, category_id, count=0):
+        with self.lock:
+            if not self._ready(): return
+            self.items[uid] = {'name': name, 'category_id': category_id or None, 'count': count}
+            self._apply(category_id or None, self._stats(count), 1)
+
+    def update_item(self, uid, name, count):
+        with self.lock:
+            if not self._ready(): return
+            item = self.items.get(uid)
+            if not item: return self.invalidate()
+            if item['count'] != count:
+                self._apply(item['category_id'], self._stats(item['count']), -1)
+                self._apply(item['category_id'], self._stats(count), 1)
+            item.update(name=name, count=count)
+
+    def move_item(self, uid, category_id):
+        with self.lock:
+            if not self._ready(): return
+            item = self.items.get(uid)
+            if not item: return self.invalidate()
+            stats = self._stats(item['count'])
+            self._apply(item['category_id'], stats, -1)
+            item['category_id'] = category_id or None
+            self._apply(item['category_id'], stats, 1)
+
+    def remove_item(self, uid):
+        with self.lock:
+            if not self._ready(): return
+            item = self.items.pop(uid, None)
+            if not item: return self.invalidate()
+            self._apply(item['category_id'], self._stats(item['count']), -1)
+
+    def move_category(self, cid, parent_id):
+        with self.lock:
+            if not self._ready(): return
+            if cid not in self.parent: return self.invalidate()
+            sub = dict(self.totals.get(cid, _blank()))
+            old = self.parent[cid]
+            self._apply(old, sub, -1)
+            if cid in self.children.get(old, []): self.children[old].remove(cid)
+            self.parent[cid] = parent_id
+            self.children.setdefault(parent_id, []).append(cid)
+            self._apply(parent_id, sub, 1)
+
+    def remove_categories(self, cids, uids=()):
+        """Drop categories and the items deleted along with them. If other items are still indexed under
+        those categories the sheet disagrees with us, so fall back to a rebuild instead."""
+        with self.lock:
+            if not self._ready(): return
+            cids = set(cids)
+            for uid in uids:
+                self.remove_item(uid)
+            if any(i['category_id'] in cids for i in self.items.values()):
+                return self.invalidate()
+            for cid in cids:
+                old = self.parent.pop(cid, None)
+                self.totals.pop(cid, None)
+                if cid in self.children.get(old, []): self.children[old].remove(cid)
+                self.children.pop(cid, None)
+
+    def subtree(self, cid):
+        return walk_subtree(cid, self.children)
+
+    def low_stock(self, threshold, cid=None):
+        with self.lock:
+            cats = set(self.subtree(cid)) if cid is not None else None
+            return [{'uid': uid, 'name': i['name'], 'count': i['count'], 'category_id': i['category_id']}
+                    for uid, i in self.items.items()
+                    if i['count'] <= threshold and (cats is None or i['category_id'] in cats)]
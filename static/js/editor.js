@@ -0,0 +1,91 @@
+const uid    = document.body.dataset.uid;
+const parent = document.body.dataset.parent;
+const $btnImg = $("#uploadBtn");
+const UP_ICON    = "/static/upload_button.png";
+const LOADING_GIF= "/static/loading.gif";
+
+function genQR() {
+    const url = window.location.href;
+    const encoded = btoa(url)
+        .replace(/\+/g, '-')
+        .replace(/\//g, '_')
+        .replace(/=+$/, '');
+    window.open('/api/qr/' + encoded, '_blank');
+}
+
+function copyid(e){
+  const s=e.target, t=s.textContent;
+  navigator.clipboard.writeText(t).then(()=>{
+    s.textContent="Copied!"; setTimeout(()=>s.textContent=t,1e3);
+  });
+}
+
+function toggleUploadButton(){
+  $("#uploadWrapper").toggle($("#imageContainer img").length < 3);
+}
+toggleUploadButton();
+
+function save(){
+  $.post("/api/item/"+uid,{name:$("#name").val(),count:$("#count").val()})
+    .done(d=> d.success ? location.href="/?cat="+parent : alert(d.message));
+}
+function cancel(){ location.href="/?cat="+parent }
+
+function spinner(on){
+  $btnImg.attr("src", on ? LOADING_GIF : UP_ICON);
+  $("#uploadWrapper").css("pointer-events", on ? "none" : "auto");
+}
+spinner(true);
+$(window).on("load", ()=> spinner(false));
+
+$("#uploadBtn").click(()=> $("#imageInput").click());
+$("#imageInput").on("change", e=>{
+  const free=3-$("#imageContainer img").length;
+  const files=[...e.target.files].slice(0,free); if(!files.length) return;
+  const fd=new FormData(); files.forEach(f=>fd.append("file",f));
+
+  spinner(true);
+  $.ajax({
+    url:`/api/upload_image/${uid}`,
+    type:"POST",
+    data:fd,
+    processData:false,
+    contentType:false
+  }).done(d=>{
+    spinner(false);
+    if(d.success){
+      d.images.forEach(im=> $("#imageContainer").append(
+        `<img class="uploaded-img" src="${im.image_path}" data-full="${im.full_path}">`
+      ));
+      toggleUploadButton();
+      $("#imageInput").val("");
+      if(d.failed) alert(d.message);
+    } else alert(d.message);
+  }).fail(()=> spinner(false));
+});
+
+$(document).on("click", ".uploaded-img", function(){
+  const img=this;
+
+  if(img.__timer){
+    clearTimeout(img.__timer); img.__timer=null;
+
+    if(confirm("Delete this image?")){
+      spinner(true);
+      const rel = img.src.startsWith(location.origin)
+                 ? img.src.slice(location.origin.length) : img.src;
+
+      $.post(`/api/delete_image/${uid}`, { thumb: rel })
+        .done(d=>{
+          spinner(false);
+          if(d.success){ $(img).remove(); toggleUploadButton(); }
+          else alert(d.message);
+        }).fail(()=> spinner(false));
+    }
+  }else{
+    img.__timer=setTimeout(()=>{
+      img.__timer=null;
+      window.open($(img).data("full"), "_blank");
+    },300);
+  }
+});
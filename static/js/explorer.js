@@ -0,0 +1,47 @@
+const catId    = document.body.dataset.catId;
+const parentId = document.body.dataset.parentId;
+let selected=null;
+function selectItem(el,t,id){document.querySelectorAll('.selected').forEach(x=>x.classList.remove('selected'));el.classList.add('selected');selected={type:t,id:id}}
+function goBack(){const pid=parentId;location.href=pid?"/?cat="+pid:"/"}
+function openFolder(id){location.href="/?cat="+id}
+function openItem(uid){const p=new URLSearchParams(location.search);const c=p.get('cat');location.href="/edit/"+uid+(c?"?cat="+c:"")}
+function newSubCategory(){const name=prompt("Enter sub category name:");if(!name)return;$.post("/api/new_category",{name,parent_id:catId}).done(d=>d.success?location.reload():alert(d.message))}
+function newItem(){const name=prompt("Enter item name:");if(!name)return;$.post("/api/new_item",{name,category_id:catId}).done(d=>d.success?location.reload():alert(d.message))}
+function deleteSelected(){if(!selected)return alert("Select something first.");if(!confirm("Delete "+selected.type+"?"))return;$.post("/api/delete",selected).done(d=>{
+  if(d.success)return location.reload();
+  if(selected.type==="category"&&d.message==="Not empty"&&confirm("This category or its sub categories contain items. Delete everything inside it?"))
+    return $.post("/api/delete",{...selected,cascade:1}).done(r=>r.success?location.reload():alert(r.message));
+  alert(d.message)})}
+  function dragStart(e,el){
+    let type = el.classList.contains("folder") ? "category" : "item";
+    let id   = type==="category" ? el.dataset.id : el.dataset.uid;
+    e.dataTransfer.setData("application/json", JSON.stringify({type,id}));
+  }
+
+  function dragOver(e,el){
+    e.preventDefault();
+    el.classList.add("drag-over");
+  }
+
+  function dragLeave(e,el){
+    el.classList.remove("drag-over");
+  }
+
+  function drop(e,el){
+    e.preventDefault();
+    el.classList.remove("drag-over");
+    let raw = e.dataTransfer.getData("application/json");
+    if(!raw) return;
+    let obj = JSON.parse(raw);
+    let path = el.getAttribute("data-path");
+    if(!path) return alert("Invalid drop target");
+    $.post("/api/move", { type: obj.type, id: obj.id, path }, res => {
+  if (!res.success) {
+    if (res.message) { 
+      alert(res.message);
+    }
+  } else {
+    location.reload();
+  }
+    });
+  }